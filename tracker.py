@@ -1,22 +1,30 @@
-import imghdr
 import io
 import os
 import smtplib
 import sys
 from datetime import datetime, timedelta
 from email.message import EmailMessage
-from functools import partial
-from operator import add, mul
+from functools import lru_cache
 from typing import Tuple, Union
 
 import gspread
+import numpy as np
 import pandas as pd
 from dotenv import load_dotenv
 from matplotlib import pyplot as plt
-from pandas.core.indexes.datetimes import DatetimeIndex
+from pandas import DatetimeIndex
 
 load_dotenv()
 
+# strftime directives that depend on the time of day
+_TIME_DIRECTIVES = ("%H", "%I", "%M", "%S", "%f", "%p", "%X", "%c")
+
+
+@lru_cache(maxsize=32)
+def _format_date_following(date: datetime, delta: int, date_format: str) -> str:
+    """Function formats the date delta days after date. Cached as, for formats without a
+    time of day, the result only changes once per day."""
+    return (date + timedelta(delta)).strftime(date_format)
 
 
 def date_following(
@@ -43,13 +51,16 @@ def date_following(
     if date is None:
         date = datetime.today()
 
-    future_date = date + timedelta(delta)
-
-    return (future_date).strftime(date_format)
+    if not any(directive in date_format for directive in _TIME_DIRECTIVES):
+        # the time of day doesn't show in the result, so all calls on a day share a cache entry
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    return _format_date_following(date, delta, date_format)
 
 
+@lru_cache(maxsize=1)
 def fetch_worksheet() -> gspread.worksheet.Worksheet:
-    """Function fetches the google sheet from the web to allow reading/editing."""
+    """Function fetches the google sheet from the web to allow reading/editing.
+    The worksheet is cached so repeated calls do not re-authenticate."""
     gc = gspread.service_account("credentials.json")
     return gc.open("weight_measurements_kg").sheet1
 
@@ -64,32 +75,41 @@ def extract_sheet_data(
 ) -> pd.DataFrame:
     """Function takes a google spreadsheet and extracts the data into a pandas dataframe.
     date is converted to appropriate types, the date is set as the index, the rows are sorted
-    so that most recent is last, and gaps are replaced with NaNs.
+    so that most recent is last, and gaps are replaced with NaNs. Rows whose date can't be parsed
+    are dropped.
 
     Args:
         worksheet (gspread.worksheet.Worksheet): A google worksheet instance from which the data
         can be accessed.
         limit (Optional[int]): limit the number of records returned. Default = 30
 
-
     Returns:
         pd.DataFrame: A dataframe containing the date from the spreadsheet.
     """
-    records = worksheet.get_all_records()
-    if not records:
+    header, *rows = worksheet.get_all_values() or [[]]
+    if not rows:
         return
     else:
-        df = pd.DataFrame(records)
-        df.mask(df == '', inplace=True)
-
-    n_records_to_return = min(df.shape[0], limit)
-    df["Date"] = df.Date.astype("datetime64[ns]")
-    df["Weight"] = df.Weight.astype("float64")
-    return (
-        df.set_index("Date")
-        .sort_values(by="Date")
-        .iloc[-n_records_to_return:, :]
-    )
+        df = pd.DataFrame(rows, columns=header)
+
+    # a mistyped date becomes NaT rather than failing the whole run; those rows can't be placed in time
+    df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%y", errors="coerce", cache=True)
+    df = df[df["Date"].notna()]
+    if df.empty:
+        return
+    df["Weight"] = pd.to_numeric(df["Weight"], errors="coerce").astype("float64")
+    if len(df) == 1:
+        # a single record needs no sorting
+        df = df.set_index("Date")
+    else:
+        n_records_to_return = min(df.shape[0], limit)
+        # select the most recent records without sorting the whole sheet
+        df = (
+            df.nlargest(n_records_to_return, "Date")
+            .set_index("Date")
+            .sort_index()
+        )
+    return df
 
 
 def get_progression(
@@ -141,38 +161,69 @@ def get_progression(
             'direction must be one of: "positive", "negative".'
         )
 
+    sign = 1.0 if direction == "positive" else -1.0
+    steps = np.arange(index.shape[0])  # step 0 is the starting weight
     if pct:
-        if direction == "positive":
-            increment = 1 + increment
-        else:
-            increment = 1 - increment
-        increment_func = partial(mul, increment)
+        factor = 1.0 + sign * increment
+        progression = start_value * factor**steps
     else:
-        if direction == "negative":
-            increment *= -1
-        increment_func = partial(add, increment)
-
-    n_incerements = index.shape[0] - 1  # accounting for starting weight
-    progression = [start_value]
-    for _ in range(n_incerements):
-        new_value = increment_func(progression[-1])
-        progression.append(new_value)
+        delta = sign * increment
+        progression = start_value + delta * steps
 
     return pd.DataFrame({"goal_progression": progression}, index=index)
 
 
+def weekly_mean(df: pd.DataFrame) -> pd.Series:
+    """Function calculates the average weight for each week in df. Weeks are grouped on their
+    weekly periods rather than resampled, and labelled with the sunday the week ends on. Weeks
+    without any rows are kept as NaN, as resample('W') would.
+
+    Args:
+        df (pd.DataFrame): A dataframe containing time vs. weight data.
+
+    Returns:
+        pd.Series: The average weight of each week.
+    """
+    weekly = df["Weight"].groupby(df.index.to_period("W")).mean()
+    weekly = weekly.reindex(pd.period_range(weekly.index[0], weekly.index[-1], freq="W"))
+    weekly.index = weekly.index.to_timestamp(how="end").normalize()
+    return weekly
+
+
+@lru_cache(maxsize=1)
+def _get_axes() -> Tuple[plt.Figure, plt.Axes]:
+    """Function creates the figure used by plot_trend on first use. It is cached and cleared
+    by plot_trend, so repeated plots skip figure setup."""
+    return plt.subplots(figsize=(15, 5))
+
+
 def plot_trend(
-    df: pd.DataFrame, figsize: Tuple[int] = (15, 5), save_path=False
-) -> None:
+    df: pd.DataFrame,
+    weekly: pd.Series = None,
+    figsize: Tuple[int] = (15, 5),
+    save_path=False,
+) -> plt.Figure:
     """Function plots the trends in the date provided in df over time.
 
     Args:
         df (pd.DataFrame): A dataframe containing time vs. weight data.
+        weekly (pd.Series, optional): Precomputed weekly average weights. If not provided
+        they are calculated from df, unless df has fewer than two rows in which case the
+        weekly line is not plotted. Defaults to None.
         figsize (Tuple[int], optional): The size of the figure. Defaults to (15, 5).
+
+    Returns:
+        plt.Figure: The plotted figure. The same figure is reused by every call, so a figure
+        returned earlier is cleared and resized by the next call; save it before plotting again.
     """
-    fig, ax = plt.subplots(figsize=figsize)
-    df.plot(ax=ax)
-    df.Weight.resample("W").mean().plot(ax=ax, style="--")
+    if weekly is None and len(df) >= 2:
+        weekly = weekly_mean(df)
+    fig, ax = _get_axes()
+    ax.cla()
+    fig.set_size_inches(figsize)
+    ax.plot(df.index.values, df["Weight"].values, label="Weight")
+    if weekly is not None:
+        ax.plot(weekly.index.values, weekly.values, "--", label="Weekly average")
     goal_progression = get_progression(
         df.iloc[0].Weight.item(),
         increment=1 / 7,
@@ -180,7 +231,13 @@ def plot_trend(
         pct=False,
         index=df.index,
     )
-    goal_progression.plot(ax=ax, color="r", style=":")
+    ax.plot(
+        goal_progression.index.values,
+        goal_progression.values.ravel(),
+        "r:",
+        label="goal_progression",
+    )
+    ax.legend()
     if df.iloc[0].name == df.iloc[-1].name:
         ax.set_xlim(df.iloc[0].name, None)
     else:
@@ -202,17 +259,16 @@ def main():
     if df is None:
         msg.set_content(f"Happy {datetime.today().strftime('%A')}. Get a streak going so you can see a trend.")
     else:
-        weekly_averages = df.resample('W').mean()
-        if weekly_averages.shape[0] >= 2:
-            weekly_average_change = (weekly_averages.Weight.iloc[-1] - weekly_averages.Weight.iloc[-2]).round(2).item()
+        change_msg = f"Happy {datetime.today().strftime('%A')}. Not enough data points to get a weekly diff."
+        weekly_averages = weekly_mean(df) if len(df) >= 2 else None
+        # a week with no measurements is NaN, so the change is only ever between consecutive weeks
+        if weekly_averages is not None and weekly_averages.shape[0] >= 2 and weekly_averages.iloc[-2:].notna().all():
+            weekly_average_change = (weekly_averages.iloc[-1] - weekly_averages.iloc[-2]).round(2).item()
             change_msg = f"Happy {datetime.today().strftime('%A')}. Your weekly average change is {weekly_average_change}"
-        else:
-            change_msg = f"Happy {datetime.today().strftime('%A')}. Not enough data points to get a weekly diff."
         buf = io.BytesIO()
-        fig = plot_trend(df, save_path="tmp/fig.png")
-        fig.savefig(buf, format='png')
-        buf.seek(0)
-        img = buf.read()
+        fig = plot_trend(df, weekly=weekly_averages, save_path="tmp/fig.png")
+        fig.savefig(buf, format='png', dpi=80)
+        img = buf.getvalue()
         msg.set_content(change_msg)
         msg.add_attachment(img, maintype="image", subtype='png', filename='Progress')
     